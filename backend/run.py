@@ -10,34 +10,42 @@ from pathlib import Path
 # Add current directory to Python path
 sys.path.insert(0, str(Path(__file__).parent))
 
-# Load environment variables
-try:
-    from dotenv import load_dotenv
-    load_dotenv()
-except ImportError:
-    print("python-dotenv not installed, skipping .env loading")
+# Load environment variables, unless a parent process or the deployment already did
+if not os.getenv("RAGFLOW_ENV_LOADED"):
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+        # Inherited by the uvicorn reloader's worker, so app.py skips its own .env read
+        os.environ["RAGFLOW_ENV_LOADED"] = "1"
+    except ImportError:
+        print("python-dotenv not installed, skipping .env loading")
 
 if __name__ == "__main__":
     import uvicorn
     
+    # Snapshot the environment once; the checks and banner below read from it
+    get = dict(os.environ).get
+    openai_key = get("OPENAI_API_KEY")
+    
     # Require only OpenAI API key
-    if not os.getenv("OPENAI_API_KEY"):
+    if not openai_key:
         print("ERROR: Missing required environment variable: OPENAI_API_KEY")
         print("Please set it in your .env file or environment")
         sys.exit(1)
     
-    print("Starting RAGFlow Backend...")
-    print(f"Working directory: {os.getcwd()}")
-    print("Embeddings: OpenAI")
-    print(f"OpenAI API Key: {'Set' if os.getenv('OPENAI_API_KEY') else 'Missing'}")
-    print(f"OpenAI Embed Model: {os.getenv('OPENAI_EMBED_MODEL', 'text-embedding-3-small')}")
-    
-    print(f"Claude Model: {os.getenv('CLAUDE_MODEL', 'claude-3-sonnet-20240229')}")
-    
-    print(f"Anthropic API Key: {'Set' if os.getenv('ANTHROPIC_API_KEY') else 'Missing'}")
-    print(f"Chunk Size: {os.getenv('CHUNK_SIZE', '800')}")
-    print(f"Chunk Overlap: {os.getenv('CHUNK_OVERLAP', '150')}")
-    print()
+    # Emit the banner as one write rather than a print per line
+    print("\n".join([
+        "Starting RAGFlow Backend...",
+        f"Working directory: {os.getcwd()}",
+        "Embeddings: OpenAI",
+        f"OpenAI API Key: {'Set' if openai_key else 'Missing'}",
+        f"OpenAI Embed Model: {get('OPENAI_EMBED_MODEL', 'text-embedding-3-small')}",
+        f"Claude Model: {get('CLAUDE_MODEL', 'claude-3-sonnet-20240229')}",
+        f"Anthropic API Key: {'Set' if get('ANTHROPIC_API_KEY') else 'Missing'}",
+        f"Chunk Size: {get('CHUNK_SIZE', '800')}",
+        f"Chunk Overlap: {get('CHUNK_OVERLAP', '150')}",
+        "",
+    ]))
     
     uvicorn.run(
         "app:app",